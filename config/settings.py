@@ -1,3 +1,5 @@
+import os
+
 # Page configuration
 PAGE_CONFIG = {
     "page_title": "AI-Powered Financial Data Analysis App",
@@ -80,4 +82,14 @@ STANDARD_CATEGORIES = ["transaction_date", "amount", "description", "category",
 API_KEYS = {
     "openai": "your-openai-api-key",  # Replace with actual key or use st.secrets
     "huggingface": "your-huggingface-api-key"  # Replace with actual key or use st.secrets
-}
\ No newline at end of file
+}
+
+# Firebase Web API key for the Auth REST API (password sign-in).
+# Leave empty to fall back to an Admin SDK email lookup without
+# password validation.
+FIREBASE_WEB_API_KEY = os.environ.get("FIREBASE_WEB_API_KEY", "")
+
+# Firebase Storage bucket for Parquet dataset blobs, e.g.
+# "my-project.firebasestorage.app". Leave empty to skip blob storage and
+# save datasets as row documents in Firestore instead.
+FIREBASE_STORAGE_BUCKET = os.environ.get("FIREBASE_STORAGE_BUCKET", "")
\ No newline at end of file
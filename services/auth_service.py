@@ -1,38 +1,143 @@
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
+from dataclasses import dataclass
 import os
 import json
-from datetime import datetime
+import requests
+from config.settings import FIREBASE_WEB_API_KEY, FIREBASE_STORAGE_BUCKET
+
+# The firebase_admin stack (grpcio, google-api-core, proto-plus) is
+# imported lazily inside the functions that need it, so demo-mode
+# sessions never pay its cold-start cost.
+
+# Checked once at import time so steady-state calls skip the stat syscall
+_SERVICE_ACCOUNT_PATH = "serviceAccountKey.json"
+_HAS_SERVICE_ACCOUNT = os.path.exists(_SERVICE_ACCOUNT_PATH)
+
+# Built once so demo uid derivation is a single pass over the email
+_DEMO_TRANS = str.maketrans("@.", "__")
+
+def _demo_uid(email):
+    """Demo-mode uid derived from the email address."""
+    return f"demo_user_{email.translate(_DEMO_TRANS)}"
+
+@dataclass(frozen=True, slots=True)
+class UserContext:
+    """Per-session user identity, resolved once at login instead of
+    re-sniffing the uid string on every storage call."""
+    uid: str
+    is_demo: bool
+    db: object = None
+
+def _build_user_context(uid):
+    """Resolve a uid into a UserContext; demo users never touch Firestore."""
+    is_demo = uid.startswith("demo_user_")
+    return UserContext(uid=uid, is_demo=is_demo, db=None if is_demo else get_db())
+
+def get_user_context(user_id):
+    """Return the session's UserContext for user_id, building it if needed."""
+    ctx = st.session_state.get("user_ctx")
+    if ctx is None or ctx.uid != user_id:
+        ctx = _build_user_context(user_id)
+        st.session_state["user_ctx"] = ctx
+    return ctx
+
+def _firebase_configured():
+    """True when Firebase credentials are available to this deployment."""
+    if _HAS_SERVICE_ACCOUNT:
+        return True
+    try:
+        return "firebase" in st.secrets
+    except Exception:
+        return False
 
 @st.cache_resource
 def initialize_firebase():
     """Initialize Firebase Admin SDK for authentication and Firestore database."""
+    # Demo-only deployments skip the entire Firebase stack, imports included
+    if not _firebase_configured():
+        return None
+
+    import firebase_admin
+    from firebase_admin import credentials
+
     if not firebase_admin._apps:
         try:
             # For local development, use a service account file
-            if os.path.exists("serviceAccountKey.json"):
-                cred = credentials.Certificate("serviceAccountKey.json")
+            if _HAS_SERVICE_ACCOUNT:
+                cred = credentials.Certificate(_SERVICE_ACCOUNT_PATH)
             # For Streamlit Cloud, use secrets
             else:
                 key_dict = st.secrets["firebase"]
                 cred = credentials.Certificate(key_dict)
-            
-            firebase_admin.initialize_app(cred)
-            # Initialize Firestore
-            db = firestore.client()
-            return firebase_admin
+
+            # Only wire up a storage bucket when one is configured; bucket
+            # names vary by project age, so guessing one is unreliable
+            options = None
+            if FIREBASE_STORAGE_BUCKET:
+                options = {"storageBucket": FIREBASE_STORAGE_BUCKET}
+            firebase_admin.initialize_app(cred, options)
         except Exception as e:
             st.error(f"Firebase initialization error: {str(e)}")
             st.info("Please ensure Firebase credentials are properly configured.")
             return None
+
+    # Stash the client on the function itself so get_db() is a single
+    # attribute read on the steady-state path
+    initialize_firebase.db = _firestore_client()
     return firebase_admin
 
+@st.cache_resource
+def _firestore_client():
+    """Construct the Firestore client wrapper once and share it across reruns."""
+    from firebase_admin import firestore
+    return firestore.client()
+
+@st.cache_resource
+def _async_firestore_client():
+    """Construct the async Firestore client once and share it across reruns."""
+    from firebase_admin import firestore_async
+    return firestore_async.client()
+
+def get_async_db():
+    """Get the async Firestore client, for overlapping writes in one rerun"""
+    if initialize_firebase():
+        return _async_firestore_client()
+    return None
+
 def get_db():
     """Get Firestore database client"""
-    firebase_app = initialize_firebase()
-    if firebase_app:
-        return firestore.client()
+    db = getattr(initialize_firebase, "db", None)
+    if db is not None:
+        return db
+    if initialize_firebase():
+        return initialize_firebase.db
+    return None
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _lookup_uid(email):
+    """Resolve an email to a Firebase uid, cached briefly so rapid
+    Streamlit reruns of the login form do not repeat the RPC."""
+    from firebase_admin import auth
+    return auth.get_user_by_email(email).uid
+
+def _sign_in_with_password(email, password):
+    """
+    Validate credentials against the Firebase Auth REST API.
+
+    A single round-trip that both checks the password and returns the
+    uid; requires FIREBASE_WEB_API_KEY to be configured.
+
+    Returns:
+        User ID if the credentials are valid, None otherwise
+    """
+    response = requests.post(
+        "https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword",
+        params={"key": FIREBASE_WEB_API_KEY},
+        json={"email": email, "password": password, "returnSecureToken": True},
+        timeout=10
+    )
+    if response.ok:
+        return response.json()["localId"]
     return None
 
 def login_user(email, password):
@@ -50,15 +155,24 @@ def login_user(email, password):
         firebase_app = initialize_firebase()
         if not firebase_app:
             # If Firebase isn't configured properly, use demo mode
-            return "demo_user_" + email.replace("@", "_").replace(".", "_")
-        
-        # In production, we would use Firebase Auth REST API
-        # For this implementation, we're checking if the user exists
+            uid = _demo_uid(email)
+            st.session_state["user_ctx"] = _build_user_context(uid)
+            return uid
+
         try:
-            user = auth.get_user_by_email(email)
-            # In a real app, you would validate password with Firebase Auth
-            # Here we're just returning the user if found
-            return user.uid
+            if FIREBASE_WEB_API_KEY:
+                # Validate the password and fetch the uid in one round-trip
+                uid = _sign_in_with_password(email, password)
+                if not uid:
+                    st.error("Login error: invalid email or password")
+                    return None
+            else:
+                # No web API key configured: fall back to a cached email
+                # lookup (no password validation, as before)
+                uid = _lookup_uid(email)
+
+            st.session_state["user_ctx"] = _build_user_context(uid)
+            return uid
         except Exception as e:
             st.error(f"Login error: {str(e)}")
             return None
@@ -82,8 +196,12 @@ def create_user(email, password):
         firebase_app = initialize_firebase()
         if not firebase_app:
             # If Firebase isn't configured properly, use demo mode
-            return "demo_user_" + email.replace("@", "_").replace(".", "_")
-        
+            uid = _demo_uid(email)
+            st.session_state["user_ctx"] = _build_user_context(uid)
+            return uid
+
+        from firebase_admin import auth, firestore
+
         # Create the user in Firebase Auth
         user = auth.create_user(
             email=email,
@@ -92,16 +210,17 @@ def create_user(email, password):
         )
         
         # Initialize user document in Firestore
-        db = firestore.client()
+        db = _firestore_client()
         db.collection("users").document(user.uid).set({
             "email": email,
-            "created_at": datetime.now().isoformat(),
+            "created_at": firestore.SERVER_TIMESTAMP,
             "settings": {
                 "currency": "USD",
                 "theme": "light"
             }
         })
-        
+
+        st.session_state["user_ctx"] = _build_user_context(user.uid)
         return user.uid
             
     except Exception as e:
@@ -1,8 +1,123 @@
 import streamlit as st
-import firebase_admin
-from firebase_admin import firestore
+import asyncio
+from collections import OrderedDict
 from datetime import datetime
-from services.auth_service import initialize_firebase, get_db
+import io
+import threading
+from services.auth_service import get_async_db, get_user_context
+
+# firebase_admin is imported lazily inside the Firestore branches below;
+# demo-mode calls short-circuit to session state before ever loading it.
+
+def _safe_id(file_id):
+    """Make an arbitrary file name usable as a Firestore document ID."""
+    return str(file_id).replace("/", "_")
+
+# Datasets are sharded into one subcollection per type, so filtering by
+# type never needs a where() clause or a composite index
+_DATASET_COLLECTION_PREFIX = "financial_data__"
+
+# Projection for dataset pickers that only list saved datasets - skips
+# downloading any row payload still stored inline on older documents
+DATASET_SUMMARY_FIELDS = ["type", "created_at", "row_count"]
+
+def _dataset_collection(db, user_id, data_type):
+    """The user's dataset subcollection for one data type."""
+    return (db.collection("users").document(user_id)
+            .collection(f"{_DATASET_COLLECTION_PREFIX}{data_type}"))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_mappings(user_id, file_name, _db):
+    """
+    Fetch a user's column mappings for a file from Firestore.
+
+    Cached per (user_id, file_name) for 5 minutes so Streamlit reruns in
+    the mapping UI do not re-hit Firestore; keying on user_id is what
+    keeps the globally shared cache safe across sessions. The client is
+    passed with a leading underscore so Streamlit does not try to hash it.
+    """
+    db = _db
+    if not db:
+        return None
+
+    from firebase_admin import firestore
+
+    # Mappings are keyed by file id, so this is a direct document get -
+    # no index scan, no query planner
+    mappings_ref = db.collection("users").document(user_id).collection("mappings")
+    doc_ref = mappings_ref.document(_safe_id(file_name))
+
+    # Read the mapping and bump last_used atomically, in one gRPC stream
+    # instead of a get RPC followed by an update RPC
+    @firestore.transactional
+    def _get_and_touch(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        if snapshot.exists:
+            # Sentinel values mutate server-side, so neither field needs a
+            # read-modify-write even under concurrent access
+            transaction.update(doc_ref, {
+                "last_used": firestore.SERVER_TIMESTAMP,
+                "access_count": firestore.Increment(1)
+            })
+        return snapshot
+
+    doc = _get_and_touch(db.transaction())
+
+    if not doc.exists:
+        return None
+
+    return doc.to_dict()["mappings"]
+
+# Rows per concurrent commit - small enough to keep many RPCs in flight
+_MINIBATCH_ROWS = 50
+
+# Demo sessions keep at most this many saved datasets in session state
+_DEMO_MAX_SAVED = 10
+
+def _to_parquet_bytes(data_df):
+    """Serialize a DataFrame to compressed Parquet bytes."""
+    buf = io.BytesIO()
+    data_df.to_parquet(buf, compression="zstd")
+    return buf.getvalue()
+
+async def _commit_minibatch(adb, rows_ref, rows):
+    """Commit one minibatch of row documents, retrying transient Firestore errors."""
+    from google.api_core import exceptions as api_exceptions
+
+    delay = 0.5
+    for attempt in range(5):
+        try:
+            batch = adb.batch()
+            for row in rows:
+                batch.set(rows_ref.document(), row)
+            await batch.commit()
+            return
+        except (api_exceptions.Aborted, api_exceptions.DeadlineExceeded):
+            if attempt == 4:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+async def _commit_rows(adb, rows_ref, chunks):
+    """Issue all minibatch commits concurrently on the async client."""
+    await asyncio.gather(*[
+        _commit_minibatch(adb, rows_ref, chunk) for chunk in chunks
+    ])
+
+@st.cache_resource
+def _async_loop():
+    """Long-lived event loop for the shared async Firestore client.
+
+    The client's gRPC channel binds to the first loop it runs on, so a
+    throwaway asyncio.run() loop per save would leave the cached client
+    tied to a closed loop and fail every save after the first.
+    """
+    return asyncio.new_event_loop()
+
+# Streamlit sessions run in separate threads but share the cached loop,
+# and run_until_complete on a loop already running in another thread
+# raises RuntimeError - serialize access instead
+_async_loop_lock = threading.Lock()
 
 def save_column_mappings(user_id, file_id, mappings):
     """
@@ -16,7 +131,8 @@ def save_column_mappings(user_id, file_id, mappings):
     Returns:
         Success boolean
     """
-    if not user_id or user_id.startswith("demo_user_"):
+    ctx = get_user_context(user_id) if user_id else None
+    if ctx is None or ctx.is_demo:
         # Handle demo mode with session state storage
         if 'saved_mappings' not in st.session_state:
             st.session_state.saved_mappings = {}
@@ -25,20 +141,25 @@ def save_column_mappings(user_id, file_id, mappings):
             "last_used": datetime.now().isoformat()
         }
         return True
-    
-    db = get_db()
+
+    db = ctx.db
     if not db:
         return False
     
     try:
+        from firebase_admin import firestore
+
         mapping_doc = {
             "file_name": file_id,
             "mappings": mappings,
-            "created_at": datetime.now().isoformat(),
-            "last_used": datetime.now().isoformat()
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "last_used": firestore.SERVER_TIMESTAMP
         }
         
-        db.collection("users").document(user_id).collection("mappings").add(mapping_doc)
+        # Keyed by file id so later lookups are a direct document get
+        mappings_ref = db.collection("users").document(user_id).collection("mappings")
+        mappings_ref.document(_safe_id(file_id)).set(mapping_doc, merge=True)
+        _cached_mappings.clear()
         return True
     except Exception as e:
         st.error(f"Error saving mappings: {str(e)}")
@@ -57,37 +178,17 @@ def get_existing_mappings(user_id, file_name):
     """
     if not user_id:
         return None
-    
+
+    ctx = get_user_context(user_id)
+
     # Handle demo mode
-    if user_id.startswith("demo_user_"):
+    if ctx.is_demo:
         if 'saved_mappings' in st.session_state and file_name in st.session_state.saved_mappings:
             return st.session_state.saved_mappings[file_name]["mappings"]
         return None
-    
-    db = get_db()
-    if not db:
-        return None
-    
+
     try:
-        # Query Firestore for similar mappings
-        mappings_ref = db.collection("users").document(user_id).collection("mappings")
-        
-        # Find mappings with similar file names
-        similar_mappings = mappings_ref.where("file_name", "==", file_name).limit(1).get()
-        
-        if not similar_mappings or len(list(similar_mappings)) == 0:
-            return None
-        
-        # Return the most recently used mapping
-        for doc in similar_mappings:
-            mapping_data = doc.to_dict()
-            
-            # Update the last_used timestamp
-            doc.reference.update({"last_used": datetime.now().isoformat()})
-            
-            return mapping_data["mappings"]
-        
-        return None
+        return _cached_mappings(user_id, file_name, ctx.db)
     except Exception as e:
         st.warning(f"Could not retrieve existing mappings: {str(e)}")
         return None
@@ -105,7 +206,8 @@ def update_column_mappings(user_id, file_id, updated_mappings):
         Success boolean
     """
     # Handle demo mode
-    if not user_id or user_id.startswith("demo_user_"):
+    ctx = get_user_context(user_id) if user_id else None
+    if ctx is None or ctx.is_demo:
         if 'saved_mappings' not in st.session_state:
             st.session_state.saved_mappings = {}
         st.session_state.saved_mappings[file_id] = {
@@ -113,33 +215,28 @@ def update_column_mappings(user_id, file_id, updated_mappings):
             "last_used": datetime.now().isoformat()
         }
         return True
-    
-    db = get_db()
+
+    db = ctx.db
     if not db:
         return False
     
     try:
+        from firebase_admin import firestore
+
         mapping_doc = {
             "file_name": file_id,
             "mappings": updated_mappings,
-            "updated_at": datetime.now().isoformat(),
-            "last_used": datetime.now().isoformat()
+            "updated_at": firestore.SERVER_TIMESTAMP,
+            "last_used": firestore.SERVER_TIMESTAMP
         }
         
-        # Find and update existing mapping document
+        # set(merge=True) is an upsert, so no need to query for an
+        # existing document first
         mappings_ref = db.collection("users").document(user_id).collection("mappings")
-        existing_docs = mappings_ref.where("file_name", "==", file_id).limit(1).get()
-        
-        docs_list = list(existing_docs)
-        if docs_list:
-            for doc in docs_list:
-                doc.reference.update(mapping_doc)
-                return True
-        
-        # If no existing mapping found, create new
-        mappings_ref.add(mapping_doc)
+        mappings_ref.document(_safe_id(file_id)).set(mapping_doc, merge=True)
+        _cached_mappings.clear()
         return True
-        
+
     except Exception as e:
         st.error(f"Error updating mappings: {str(e)}")
         return False
@@ -156,84 +253,181 @@ def save_financial_data(user_id, data_type, data_df):
     Returns:
         Success boolean and document ID
     """
-    if not user_id or user_id.startswith("demo_user_"):
+    ctx = get_user_context(user_id) if user_id else None
+    if ctx is None or ctx.is_demo:
         # Demo mode - store in session state
         if 'saved_financial_data' not in st.session_state:
-            st.session_state.saved_financial_data = {}
-        
+            st.session_state.saved_financial_data = OrderedDict()
+
         data_id = f"{data_type}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        st.session_state.saved_financial_data[data_id] = {
+        saved = st.session_state.saved_financial_data
+
+        # Keep the DataFrame itself - stored by reference, with none of
+        # the row-dict blowup of to_dict(orient="records"); callers
+        # convert to records at the boundary only when they need them
+        saved[data_id] = {
             "type": data_type,
-            "data": data_df.to_dict(orient="records"),
-            "created_at": datetime.now().isoformat()
+            "df": data_df,
+            "created_at": datetime.now().isoformat(),
+            "row_count": len(data_df)
         }
+        saved.move_to_end(data_id)
+
+        # Maintain the per-type id index so type filters are O(result size)
+        by_type = st.session_state.setdefault("saved_financial_data_by_type", {})
+        by_type.setdefault(data_type, []).append(data_id)
+
+        # Bound session memory by evicting the oldest saves
+        while len(saved) > _DEMO_MAX_SAVED:
+            evicted_id, evicted = saved.popitem(last=False)
+            evicted_ids = by_type.get(evicted["type"], [])
+            if evicted_id in evicted_ids:
+                evicted_ids.remove(evicted_id)
+
         return True, data_id
-    
-    db = get_db()
+
+    db = ctx.db
     if not db:
         return False, None
     
     try:
-        # Convert DataFrame to dict for Firestore
-        data_dict = {
+        from firebase_admin import firestore, storage
+
+        # Parent document holds only metadata; the row payload lives
+        # elsewhere so no single document approaches the 1 MB limit
+        dataset_ref = _dataset_collection(db, user_id, data_type).document()
+        dataset_doc = {
             "type": data_type,
-            "data": data_df.to_dict(orient="records"),
-            "created_at": datetime.now().isoformat(),
+            "created_at": firestore.SERVER_TIMESTAMP,
             "row_count": len(data_df)
         }
-        
-        # Add to Firestore
-        doc_ref = db.collection("users").document(user_id).collection("financial_data").add(data_dict)
-        return True, doc_ref.id
+
+        from google.cloud import exceptions as cloud_exceptions
+
+        try:
+            # Preferred path: one compressed Parquet blob in Firebase
+            # Storage, columnar and far cheaper than per-row documents
+            blob_bytes = _to_parquet_bytes(data_df)
+            storage_path = f"users/{user_id}/financial_data/{dataset_ref.id}.parquet"
+            storage.bucket().blob(storage_path).upload_from_string(
+                blob_bytes, content_type="application/octet-stream")
+            dataset_doc["storage_path"] = storage_path
+            dataset_doc["schema"] = data_df.dtypes.astype(str).to_dict()
+            dataset_ref.set(dataset_doc)
+            return True, dataset_ref.id
+        except (ImportError, ValueError, cloud_exceptions.GoogleCloudError) as e:
+            # ImportError: pyarrow missing; ValueError: Parquet could not
+            # serialize the frame, or no storage bucket is configured;
+            # GoogleCloudError: the bucket rejected the upload
+            st.warning(f"Parquet storage unavailable ({str(e)}); "
+                       "saving rows to Firestore instead.")
+
+        # Chunk rows into minibatches and commit them concurrently on the
+        # async client so the per-commit RPC latencies overlap
+        adb = get_async_db()
+        rows_ref = (_dataset_collection(adb, user_id, data_type)
+                    .document(dataset_ref.id).collection("rows"))
+
+        # to_dict(orient="records") per minibatch keeps the real column
+        # names and boxes numpy scalars to native types Firestore accepts
+        chunks = [data_df.iloc[i:i + _MINIBATCH_ROWS].to_dict(orient="records")
+                  for i in range(0, len(data_df), _MINIBATCH_ROWS)]
+        with _async_loop_lock:
+            _async_loop().run_until_complete(_commit_rows(adb, rows_ref, chunks))
+
+        # The parent metadata doc is written last as the commit point, so
+        # a failed row commit never leaves a listed-but-empty dataset
+        dataset_ref.set(dataset_doc)
+
+        return True, dataset_ref.id
     except Exception as e:
         st.error(f"Error saving financial data: {str(e)}")
         return False, None
 
-def get_user_financial_data(user_id, data_type=None):
+def get_user_financial_data(user_id, data_type=None, page_size=50, start_after=None,
+                            fields=None):
     """
     Get user's saved financial data from Firestore
-    
+
     Args:
         user_id: User ID
         data_type: Optional filter by data type
-        
+        page_size: Maximum number of documents to return per call
+        start_after: created_at cursor from a previous call, to resume paging
+        fields: Optional list of field paths to project (e.g.
+            DATASET_SUMMARY_FIELDS for a picker); all fields when None
+
     Returns:
-        Dictionary of financial data documents
+        Tuple of (dictionary of financial data documents, cursor for the
+        next page or None when there are no more documents)
     """
     if not user_id:
-        return {}
-    
+        return {}, None
+
+    ctx = get_user_context(user_id)
+
     # Handle demo mode
-    if user_id.startswith("demo_user_"):
+    if ctx.is_demo:
         if 'saved_financial_data' not in st.session_state:
-            return {}
-        
+            return {}, None
+
         if data_type:
-            return {k: v for k, v in st.session_state.saved_financial_data.items() 
-                   if v.get("type") == data_type}
-        return st.session_state.saved_financial_data
-    
-    db = get_db()
+            # The per-type id index makes this O(result size) rather than
+            # a scan over every saved dataset
+            saved = st.session_state.saved_financial_data
+            by_type = st.session_state.get("saved_financial_data_by_type", {})
+            return {data_id: saved[data_id]
+                    for data_id in by_type.get(data_type, ())
+                    if data_id in saved}, None
+        return st.session_state.saved_financial_data, None
+
+    db = ctx.db
     if not db:
-        return {}
-    
+        return {}, None
+
     try:
-        # Query Firestore for user's financial data
-        data_ref = db.collection("users").document(user_id).collection("financial_data")
-        
+        from firebase_admin import firestore
+
+        # One subcollection per data type; a type filter is just a choice
+        # of collection rather than a where() scan
         if data_type:
-            query = data_ref.where("type", "==", data_type)
+            collections = [_dataset_collection(db, user_id, data_type)]
         else:
-            query = data_ref
-            
-        # Get the documents
-        docs = query.get()
-        
+            user_ref = db.collection("users").document(user_id)
+            collections = [coll for coll in user_ref.collections()
+                           if coll.id.startswith(_DATASET_COLLECTION_PREFIX)]
+
         result = {}
-        for doc in docs:
-            result[doc.id] = doc.to_dict()
-            
-        return result
+        last_created_at = None
+        for data_ref in collections:
+            # Page with a query cursor instead of materializing every document;
+            # offset-based paging would bill a read for each skipped document
+            query = data_ref.order_by("created_at", direction=firestore.Query.DESCENDING)
+
+            # Project only the requested fields so listing datasets never
+            # drags row payloads over the wire; created_at always rides
+            # along because the pagination cursor is read from it
+            if fields:
+                projection = (fields if "created_at" in fields
+                              else list(fields) + ["created_at"])
+                query = query.select(projection)
+
+            if start_after is not None:
+                query = query.start_after({"created_at": start_after})
+            query = query.limit(page_size)
+
+            # Stream the documents so deserialization overlaps network I/O,
+            # building the page dict in one shot
+            page = {doc.id: doc.to_dict() for doc in query.stream()}
+            result.update(page)
+            if page:
+                last_created_at = next(reversed(page.values())).get("created_at")
+
+        # A short page means the collection is exhausted; the cursor is
+        # only meaningful when paging a single type's collection
+        next_cursor = (last_created_at
+                       if data_type and len(result) == page_size else None)
+        return result, next_cursor
     except Exception as e:
         st.warning(f"Could not retrieve financial data: {str(e)}")
-        return {}
\ No newline at end of file
+        return {}, None
\ No newline at end of file